@@ -0,0 +1,364 @@
+""" Long-running simulation service with a warm worker pool
+
+POST /simulate with a JSON body {"settings": {...}, "seed": 1234}, where
+"settings" holds overrides on top of the loaded settings file and "seed" is
+optional. The response is streamed as newline delimited JSON: one "progress"
+record per finished replication with partial confidence intervals, then a
+final "result" record. GET /health reports the pool status.
+"""
+
+import asyncio
+import concurrent.futures
+import contextlib
+import json
+import logging
+import os
+from concurrent.futures.process import BrokenProcessPool
+
+import numpy as np
+import scipy.stats as sc
+
+from highway_call_simulator import HighwayCallSimulator
+from utils_highway_call_simulator.data_generator import RandomDataGenerator
+from utils_highway_call_simulator.utility import DictClass, init_logger, get_settings_path_from_arg, merge_settings
+
+MAX_SEED = 2**32
+
+VARIABLE_KEYS = ["reserved_channel", "base_count", "base_diameter", "base_channel"]
+DISTRIBUTION_KEYS = [
+    "inter_arrival_time", "arrival_time", "base_station", "call_loc_offset",
+    "call_duration", "car_velocity", "car_direction"]
+# Distributions supported by RandomDataGenerator, with their argument count
+DISTRIBUTION_ARGS = {"uniform": 2, "randint": 2, "exponential": 1, "normal": 2}
+
+
+def init_worker(log_dir, level):
+    """ Initialise worker process logger """
+    init_logger(log_dir, "simulation_worker_{}".format(os.getpid()), level, force=True)
+    logging.info("[init_worker] Worker {} ready".format(os.getpid()))
+
+def warm_up_worker(_):
+    """ No-op task, used to start worker processes ahead of the first job """
+    return os.getpid()
+
+def is_count(value):
+    """ Check value is an integer and not a boolean """
+    return isinstance(value, int) and not isinstance(value, bool)
+
+def is_number(value):
+    """ Check value is a real number and not a boolean """
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+def validate_simulator_settings(simulator_settings, max_simulation_count, max_event):
+    """ Check merged simulator settings, raise ValueError on invalid value """
+    if not isinstance(simulator_settings, dict):
+        raise ValueError("simulator must be an object")
+    simulation_count = simulator_settings.get("simulation_count")
+    if not is_count(simulation_count) or simulation_count < 1:
+        raise ValueError("simulation_count must be a positive integer")
+    if simulation_count > max_simulation_count:
+        raise ValueError("simulation_count must not exceed {}".format(max_simulation_count))
+    if not is_count(simulator_settings.get("event")) or simulator_settings["event"] < 1:
+        raise ValueError("event must be a positive integer")
+    if simulator_settings["event"] > max_event:
+        raise ValueError("event must not exceed {}".format(max_event))
+
+    variable = simulator_settings.get("variable")
+    if not isinstance(variable, dict):
+        raise ValueError("variable must be an object")
+    for key in VARIABLE_KEYS:
+        if not is_count(variable.get(key)) or variable[key] < 0:
+            raise ValueError("variable.{} must be a non-negative integer".format(key))
+    if variable["base_count"] < 1 or variable["base_diameter"] < 1:
+        raise ValueError("variable.base_count and variable.base_diameter must be positive")
+    if variable["reserved_channel"] > variable["base_channel"]:
+        raise ValueError("variable.reserved_channel must not exceed variable.base_channel")
+
+    warm_up_threshold = simulator_settings.get("warm_up_threshold")
+    if not isinstance(warm_up_threshold, dict):
+        raise ValueError("warm_up_threshold must be an object")
+    for key in ["dropped_call", "blocked_call"]:
+        if not is_number(warm_up_threshold.get(key)):
+            raise ValueError("warm_up_threshold.{} must be a number".format(key))
+
+    distribution = simulator_settings.get("distribution")
+    if not isinstance(distribution, dict):
+        raise ValueError("distribution must be an object")
+    random_state = np.random.RandomState(0)
+    for key in DISTRIBUTION_KEYS:
+        settings = distribution.get(key)
+        if not isinstance(settings, dict) or not isinstance(settings.get("set"), list):
+            raise ValueError("distribution.{} must have 'dist' name and 'set' list".format(key))
+        if settings.get("dist") not in DISTRIBUTION_ARGS:
+            raise ValueError("distribution.{}.dist must be one of {}".format(key, sorted(DISTRIBUTION_ARGS)))
+        if len(settings["set"]) != DISTRIBUTION_ARGS[settings["dist"]] \
+                or not all(is_number(value) for value in settings["set"]):
+            raise ValueError("distribution.{}.set must be {} numbers".format(
+                key, DISTRIBUTION_ARGS[settings["dist"]]))
+        try:
+            getattr(random_state, settings["dist"])(*settings["set"])
+        except Exception as err:
+            raise ValueError("distribution.{} is invalid: {}".format(key, err))
+    base_station = distribution["base_station"]["set"]
+    if base_station[0] < 0 or base_station[-1] > variable["base_count"]:
+        raise ValueError("distribution.base_station must stay within variable.base_count")
+
+def parse_seed(request):
+    """ Get seed from request, draw fresh entropy when absent """
+    if "seed" not in request:
+        return np.random.SeedSequence().entropy % MAX_SEED
+    seed = request["seed"]
+    if not is_count(seed) or not 0 <= seed < MAX_SEED:
+        raise ValueError("seed must be an integer in [0, {})".format(MAX_SEED))
+    return seed
+
+def run_replication(simulator_settings, seed):
+    """ Run a single simulation replication, return (blocked, dropped) ratio """
+    np.random.seed(seed)
+    settings = DictClass(simulator_settings)
+    variable = settings.variable
+    simulator = HighwayCallSimulator(
+        variable.reserved_channel, variable.base_count, variable.base_diameter, variable.base_channel)
+    data_generator = RandomDataGenerator(settings.distribution, save=False)
+    # Keep the simulator report prints off the service console
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        return simulator.simulate(settings.event, data_generator, settings.warm_up_threshold)
+
+def confidence_interval(samples, confidence):
+    """ Get mean and confidence interval half width of the samples """
+    mean = float(np.mean(samples))
+    if len(samples) < 2:
+        return {"mean": mean, "half_width": None, "low": None, "high": None}
+    std_error = np.std(samples, ddof=1)/np.sqrt(len(samples))
+    half_width = float(sc.t.ppf((1+confidence)/2, len(samples)-1)*std_error)
+    return {"mean": mean, "half_width": half_width, "low": mean-half_width, "high": mean+half_width}
+
+
+class SimulationServer:
+    """ Asyncio HTTP server queueing simulation jobs to a process pool """
+    STATUS_TEXT = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed"}
+
+    def __init__(self, settings, server_settings, log_settings):
+        """ Initialization """
+        logging.info("[{}] Initialize object".format(self.__class__.__name__))
+        self.settings = settings
+        self.server_settings = server_settings
+        self.log_settings = log_settings
+        self.pool = None
+        self.pool_lock = asyncio.Lock()
+        self.job_count = 0
+        self.active_jobs = 0
+
+    def start_pool(self):
+        """ Start process pool and wait for every worker to be up """
+        workers = self.server_settings.workers
+        logging.info("[{}] Starting pool with {} workers".format(self.__class__.__name__, workers))
+        self.pool = concurrent.futures.ProcessPoolExecutor(
+            max_workers=workers, initializer=init_worker,
+            initargs=(self.log_settings.path, self.log_settings.level))
+        pids = set(self.pool.map(warm_up_worker, range(workers)))
+        logging.info("[{}] Pool warmed up, workers:{}".format(self.__class__.__name__, sorted(pids)))
+
+    def is_pool_broken(self):
+        """ Check whether a worker died and left the pool unusable """
+        return self.pool is None or getattr(self.pool, "_broken", False)
+
+    async def restart_pool(self, broken_pool):
+        """ Replace a broken pool, once even if several jobs noticed it """
+        async with self.pool_lock:
+            if self.pool is not broken_pool:
+                return
+            logging.error("[{}] Worker pool broken, restarting".format(self.__class__.__name__))
+            broken_pool.shutdown(wait=False, cancel_futures=True)
+            self.pool = None
+            await asyncio.get_running_loop().run_in_executor(None, self.start_pool)
+
+    async def start(self):
+        """ Start listening on the configured Unix socket or TCP address """
+        if self.server_settings.unix_socket:
+            server = await asyncio.start_unix_server(self.handle_client, path=self.server_settings.unix_socket)
+            address = self.server_settings.unix_socket
+        else:
+            server = await asyncio.start_server(
+                self.handle_client, self.server_settings.host, self.server_settings.port)
+            address = "{}:{}".format(*server.sockets[0].getsockname()[:2])
+        return server, address
+
+    async def serve(self):
+        """ Serve forever """
+        server, address = await self.start()
+        print("Serving on {}".format(address))
+        logging.info("[{}] Serving on {}".format(self.__class__.__name__, address))
+        async with server:
+            await server.serve_forever()
+
+    async def read_request(self, reader):
+        """ Read HTTP request, return method, path and body """
+        request_line = (await reader.readline()).decode("latin-1").split()
+        if len(request_line) != 3:
+            raise ValueError("Malformed request line")
+        method, path, _ = request_line
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            key, _, value = line.decode("latin-1").partition(":")
+            headers[key.strip().lower()] = value.strip()
+        length = int(headers.get("content-length", 0))
+        body = await reader.readexactly(length) if length > 0 else b""
+        return method, path, body
+
+    async def write_response(self, writer, status, payload):
+        """ Write a complete JSON response """
+        body = json.dumps(payload).encode()
+        writer.write("HTTP/1.1 {} {}\r\nContent-Type: application/json\r\nContent-Length: {}\r\nConnection: close\r\n\r\n".format(
+            status, SimulationServer.STATUS_TEXT[status], len(body)).encode() + body)
+        await writer.drain()
+
+    async def write_chunk(self, writer, payload):
+        """ Write one JSON line as a chunk of a chunked response """
+        line = (json.dumps(payload)+"\n").encode()
+        writer.write("{:x}\r\n".format(len(line)).encode() + line + b"\r\n")
+        await writer.drain()
+
+    async def handle_client(self, reader, writer):
+        """ Handle a single HTTP connection """
+        try:
+            try:
+                method, path, body = await self.read_request(reader)
+            except (ValueError, asyncio.IncompleteReadError) as err:
+                await self.write_response(writer, 400, {"error": str(err)})
+                return
+            logging.info("[{}] Request {} {}".format(self.__class__.__name__, method, path))
+
+            if path == "/health":
+                await self.write_response(writer, 200, {
+                    "status": "broken" if self.is_pool_broken() else "ok",
+                    "workers": self.server_settings.workers,
+                    "active_jobs": self.active_jobs,
+                    "total_jobs": self.job_count})
+            elif path != "/simulate":
+                await self.write_response(writer, 404, {"error": "Unknown path {}".format(path)})
+            elif method != "POST":
+                await self.write_response(writer, 405, {"error": "Use POST for /simulate"})
+            else:
+                try:
+                    request = json.loads(body or b"{}")
+                    if not isinstance(request, dict) or not isinstance(request.get("settings", {}), dict):
+                        raise ValueError("Request body and settings must be JSON objects")
+                    settings = merge_settings(self.settings, request.get("settings", {}))
+                    validate_simulator_settings(
+                        settings["simulator"], self.server_settings.max_simulation_count,
+                        self.server_settings.max_event)
+                    seed = parse_seed(request)
+                except (ValueError, KeyError) as err:
+                    await self.write_response(writer, 400, {"error": str(err)})
+                    return
+                except Exception as err:
+                    logging.exception("[{}] Unexpected invalid request".format(self.__class__.__name__))
+                    await self.write_response(writer, 400, {"error": repr(err)})
+                    return
+                self.active_jobs += 1
+                try:
+                    await self.run_job(writer, settings["simulator"], seed)
+                finally:
+                    self.active_jobs -= 1
+        except ConnectionError:
+            logging.warning("[{}] Client disconnected".format(self.__class__.__name__))
+        finally:
+            writer.close()
+
+    async def run_job(self, writer, simulator_settings, seed):
+        """ Queue replications to the pool and stream progress back """
+        self.job_count += 1
+        job_id = self.job_count
+        total = simulator_settings["simulation_count"]
+        confidence = self.server_settings.confidence
+        logging.info("[{}] Job {} started, replications:{}, seed:{}".format(
+            self.__class__.__name__, job_id, total, seed))
+
+        # Keep at most one replication per worker in flight, so a large job
+        # does not hold every later job behind it in the pool queue
+        loop = asyncio.get_running_loop()
+        in_flight = self.server_settings.workers
+        submitted = 0
+        pending = set()
+        async with self.pool_lock:
+            pool = self.pool
+        # Hashed seeds, so jobs with neighbouring seeds do not share replication streams
+        seeds = np.random.SeedSequence(seed).generate_state(total)
+
+        writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: application/x-ndjson\r\nTransfer-Encoding: chunked\r\nConnection: close\r\n\r\n")
+        blocked_call = []
+        dropped_call = []
+        try:
+            while submitted < total or pending:
+                while submitted < total and len(pending) < in_flight:
+                    pending.add(loop.run_in_executor(
+                        pool, run_replication, simulator_settings, int(seeds[submitted])))
+                    submitted += 1
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for future in done:
+                    blocked, dropped = future.result()
+                    blocked_call.append(blocked)
+                    dropped_call.append(dropped)
+                await self.write_chunk(writer, {
+                    "event": "progress",
+                    "job": job_id,
+                    "completed": len(blocked_call),
+                    "total": total,
+                    "blocked_call": confidence_interval(blocked_call, confidence),
+                    "dropped_call": confidence_interval(dropped_call, confidence)})
+        except ConnectionError:
+            # Drop replications that have not started yet
+            for future in pending:
+                future.cancel()
+            raise
+        except Exception as err:
+            for future in pending:
+                future.cancel()
+            logging.exception("[{}] Job {} failed".format(self.__class__.__name__, job_id))
+            if isinstance(err, BrokenProcessPool):
+                await self.restart_pool(pool)
+            await self.write_chunk(writer, {"event": "error", "job": job_id, "error": repr(err)})
+            writer.write(b"0\r\n\r\n")
+            await writer.drain()
+            return
+
+        await self.write_chunk(writer, {
+            "event": "result",
+            "job": job_id,
+            "seed": seed,
+            "replications": total,
+            "confidence": confidence,
+            "reserved_channel": simulator_settings["variable"]["reserved_channel"],
+            "blocked_call": confidence_interval(blocked_call, confidence),
+            "dropped_call": confidence_interval(dropped_call, confidence)})
+        writer.write(b"0\r\n\r\n")
+        await writer.drain()
+        logging.info("[{}] Job {} done, blocked:{}, dropped:{}".format(
+            self.__class__.__name__, job_id, np.mean(blocked_call), np.mean(dropped_call)))
+
+
+def main():
+    file_name = os.path.basename(__file__)[:-3]
+    settings_path = get_settings_path_from_arg(file_name)
+    with open(settings_path, 'r') as input_file:
+        raw_settings = json.load(input_file)
+    settings = DictClass(raw_settings)
+
+    init_logger(settings.log.path, file_name, settings.log.level)
+    logging.info("[{}] Logging initiated".format(file_name))
+
+    server = SimulationServer(raw_settings, settings.server, settings.log)
+    server.start_pool()
+    try:
+        asyncio.run(server.serve())
+    except KeyboardInterrupt:
+        logging.info("[{}] Shutting down".format(file_name))
+    finally:
+        server.pool.shutdown(cancel_futures=True)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,148 @@
+""" Tests for simulation server """
+
+import asyncio
+import copy
+import json
+import os
+import tempfile
+from concurrent.futures.process import BrokenProcessPool
+
+import pytest
+
+from simulation_server import SimulationServer, confidence_interval, validate_simulator_settings
+from utils_highway_call_simulator.utility import DictClass
+
+
+SETTINGS_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "settings.json")
+
+
+def load_raw_settings():
+    with open(SETTINGS_PATH, 'r') as input_file:
+        return json.load(input_file)
+
+def test_confidence_interval_single_sample():
+    interval = confidence_interval([0.5], 0.95)
+    assert interval == {"mean": 0.5, "half_width": None, "low": None, "high": None}
+
+def test_confidence_interval_known_t_interval():
+    # mean 2, sample std 1, t(0.975, 2) = 4.302653
+    interval = confidence_interval([1.0, 2.0, 3.0], 0.95)
+    assert interval["mean"] == pytest.approx(2.0)
+    assert interval["half_width"] == pytest.approx(4.302653/3**0.5, rel=1e-6)
+    assert interval["low"] == pytest.approx(2.0-interval["half_width"])
+    assert interval["high"] == pytest.approx(2.0+interval["half_width"])
+
+def test_validate_simulator_settings_rejects_bad_values():
+    simulator = load_raw_settings()["simulator"]
+    validate_simulator_settings(simulator, 1000, 100000)
+    for key, value in [("simulation_count", True), ("simulation_count", 1001), ("event", 100001), ("variable", 5)]:
+        invalid = copy.deepcopy(simulator)
+        invalid[key] = value
+        with pytest.raises(ValueError):
+            validate_simulator_settings(invalid, 1000, 100000)
+    for key, distribution in [
+            ("call_duration", {"dist": "unknown", "set": [1]}),
+            ("call_duration", {"dist": "seed", "set": [1]}),
+            ("base_station", {"dist": "randint", "set": [0, 20, 10**9]}),
+            ("base_station", {"dist": "random_sample", "set": []}),
+            ("base_station", {"dist": "uniform", "set": []}),
+            ("car_velocity", {"dist": "normal", "set": ["33", 2]})]:
+        invalid = copy.deepcopy(simulator)
+        invalid["distribution"][key] = distribution
+        with pytest.raises(ValueError):
+            validate_simulator_settings(invalid, 1000, 100000)
+
+async def request(address, method, path, payload=None):
+    """ Send a request, return status line and raw body """
+    host, port = address.split(":")
+    reader, writer = await asyncio.open_connection(host, int(port))
+    body = json.dumps(payload).encode() if payload is not None else b""
+    writer.write("{} {} HTTP/1.1\r\nHost: {}\r\nContent-Length: {}\r\n\r\n".format(
+        method, path, address, len(body)).encode() + body)
+    await writer.drain()
+    response = await reader.read()
+    writer.close()
+    head, _, body = response.partition(b"\r\n\r\n")
+    return head.split(b"\r\n")[0].decode(), body
+
+def parse_chunked_records(chunked):
+    """ Decode a chunked NDJSON body into records """
+    records = []
+    while chunked:
+        size, _, rest = chunked.partition(b"\r\n")
+        size = int(size, 16)
+        if size == 0:
+            break
+        records.append(json.loads(rest[:size]))
+        chunked = rest[size+2:]
+    return records
+
+def run_with_server(client, workers=2):
+    """ Start a small server, run the async client against it """
+    raw_settings = load_raw_settings()
+    raw_settings["simulator"]["event"] = 200
+    raw_settings["server"].update({"host": "127.0.0.1", "port": 0, "unix_socket": "", "workers": workers})
+    with tempfile.TemporaryDirectory() as log_dir:
+        raw_settings["log"]["path"] = log_dir
+        settings = DictClass(raw_settings)
+        server = SimulationServer(raw_settings, settings.server, settings.log)
+        server.start_pool()
+
+        async def run():
+            listener, address = await server.start()
+            async with listener:
+                return await client(server, address)
+
+        try:
+            return asyncio.run(run())
+        finally:
+            server.pool.shutdown()
+
+def test_simulate_round_trip():
+    async def client(server, address):
+        return await request(address, "POST", "/simulate", {
+            "settings": {"simulator": {"simulation_count": 3}}, "seed": 7})
+
+    status, body = run_with_server(client)
+    records = parse_chunked_records(body)
+
+    assert status == "HTTP/1.1 200 OK"
+    assert all(record["event"] == "progress" for record in records[:-1])
+    completed = [record["completed"] for record in records[:-1]]
+    assert completed == sorted(set(completed))
+    assert completed[-1] == 3
+    result = records[-1]
+    assert result["event"] == "result"
+    assert result["seed"] == 7
+    assert result["replications"] == 3
+    assert 0 <= result["blocked_call"]["mean"] <= 1
+    assert result["dropped_call"]["half_width"] is not None
+
+def test_simulate_malformed_distribution_is_bad_request():
+    async def client(server, address):
+        return await request(address, "POST", "/simulate", {"settings": {"simulator": {
+            "distribution": {"base_station": {"dist": "random_sample", "set": []}}}}})
+
+    status, body = run_with_server(client, workers=1)
+
+    assert status == "HTTP/1.1 400 Bad Request"
+    assert "base_station" in json.loads(body)["error"]
+
+def test_broken_pool_is_restarted():
+    async def client(server, address):
+        # Kill a worker, which leaves the pool permanently broken
+        await asyncio.get_running_loop().run_in_executor(None, lambda: server.pool.submit(os._exit, 1).exception())
+        _, health = await request(address, "GET", "/health")
+        _, failed = await request(address, "POST", "/simulate", {"settings": {"simulator": {"simulation_count": 1}}})
+        _, recovered = await request(address, "GET", "/health")
+        status, body = await request(address, "POST", "/simulate", {"settings": {"simulator": {"simulation_count": 1}}})
+        return json.loads(health), parse_chunked_records(failed), json.loads(recovered), status, parse_chunked_records(body)
+
+    health, failed, recovered, status, records = run_with_server(client, workers=1)
+
+    assert health["status"] == "broken"
+    assert failed[-1]["event"] == "error"
+    assert recovered["status"] == "ok"
+    assert recovered["active_jobs"] == 0
+    assert status == "HTTP/1.1 200 OK"
+    assert records[-1]["event"] == "result"
@@ -0,0 +1,29 @@
+""" Tests for utility """
+
+import copy
+
+import pytest
+
+from utils_highway_call_simulator.utility import merge_settings
+
+
+SETTINGS = {
+    "log": {"path": "logs/", "level": 20},
+    "simulator": {"event": 10000, "variable": {"reserved_channel": 0, "base_count": 20}}
+}
+
+
+def test_merge_settings_nested_override():
+    merged = merge_settings(SETTINGS, {"simulator": {"variable": {"reserved_channel": 2}}})
+    assert merged["simulator"]["variable"] == {"reserved_channel": 2, "base_count": 20}
+    assert merged["simulator"]["event"] == 10000
+    assert merged["log"] == SETTINGS["log"]
+
+def test_merge_settings_unknown_key():
+    with pytest.raises(KeyError):
+        merge_settings(SETTINGS, {"simulator": {"variable": {"reserved_channels": 2}}})
+
+def test_merge_settings_does_not_mutate_input():
+    original = copy.deepcopy(SETTINGS)
+    merge_settings(SETTINGS, {"simulator": {"event": 5, "variable": {"base_count": 3}}})
+    assert SETTINGS == original
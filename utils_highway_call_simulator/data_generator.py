@@ -17,8 +17,8 @@ from utils_highway_call_simulator.utility import init_logger, load_settings, get
 class RandomDataGenerator:
     """ Data generator class """
 
-    def __init__(self, distribution_settings):
-        """ Initialization """
+    def __init__(self, distribution_settings, save=True):
+        """ Initialization, 'save' keeps generated arrival events for later saving """
         logging.info("[{}] Initialize object".format(self.__class__.__name__))
         self.set_arrival_time_settings(distribution_settings.arrival_time)
         self.set_inter_arrival_time_settings(distribution_settings.inter_arrival_time)
@@ -30,6 +30,7 @@ class RandomDataGenerator:
 
         self.arrival_time = 0.0
         self.arrival_count = 1
+        self.save_events = save
         self.col = ['Arrival no','Arrival time (sec)','Base station (sec)', 'Call location offset (meter)','Call duration (sec)','Car velocity (m/s)','Car direction']
         self.arrival_events = pd.DataFrame(columns=self.col)
 
@@ -68,8 +69,10 @@ class RandomDataGenerator:
         logging.info("[{}] Set car_direction settings{}".format(self.__class__.__name__, settings))
         self.car_direction_settings = settings
 
-    def get_next(self, save=True):
+    def get_next(self, save=None):
         """ Get next random data """
+        if save is None:
+            save = self.save_events
         logging.debug("[{}] Generating random data, save={}".format(self.__class__.__name__, save))
         arrival_no = self.arrival_count
         arrival_time = self.arrival_time
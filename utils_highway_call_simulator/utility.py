@@ -15,15 +15,16 @@ class DictClass:
             else:
                 setattr(self, key, value)
 
-def init_logger(log_dir, file_name, level):
-    """ Initialise logger """
+def init_logger(log_dir, file_name, level, force=False):
+    """ Initialise logger, 'force' replaces handlers inherited from a parent process """
     ensure_dir(log_dir)
     log_file = os.path.join(log_dir, file_name+'_'+get_now_str()+'.log')
     logging.basicConfig(
         filename=log_file,
         filemode='w',
         level=level,
-        format='%(asctime)s [%(levelname)s][%(message)s]'
+        format='%(asctime)s [%(levelname)s][%(message)s]',
+        force=force
     )
 
 def get_now_str():
@@ -45,6 +46,18 @@ def load_settings(file_path="settings.json", detail=""):
         return DictClass(settings[detail])
     return DictClass(settings)
 
+def merge_settings(settings, overrides):
+    """ Recursively apply overrides on top of a settings dictionary """
+    merged = dict(settings)
+    for key, value in overrides.items():
+        if key not in merged:
+            raise KeyError("Unknown settings key: {}".format(key))
+        if isinstance(value, dict) and isinstance(merged[key], dict):
+            merged[key] = merge_settings(merged[key], value)
+        else:
+            merged[key] = value
+    return merged
+
 def get_settings_path_from_arg(description):
     """ Parse command line arguments for setting file """
     parser = argparse.ArgumentParser(description=description)